@@ -1,15 +1,30 @@
 # Imports
 import pandas as pd
 import numpy as np
-from ftplib import FTP # For file transfer
+from ftplib import FTP, error_perm, error_temp # For file transfer
+import time # To wait before retrying a refused FTP login
+from datetime import datetime, timezone # To compare remote and local file times
 import os # To obtain file directory and paths 
+import tempfile # To stage tables as .csv for bulk loading
 import zipfile # To read the zipped data
-import json # To parse file data
+import io # To buffer reads from the zipped data
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # To read / download files in parallel
+import orjson # To parse file data and save / load the lookup tables
+import re # To extract prices
+import pyarrow as pa # Columnar tables for the parsed data
+import pyarrow.json as pajson # Fast parsing of file data
+import pyarrow.parquet as pq # Columnar storage of the cleaned data
+import functools # To reuse the SQL engine
 from sqlalchemy import create_engine, text, MetaData, Table # SQL engine
+from sqlalchemy.exc import DBAPIError # To detect a server that refuses LOAD DATA LOCAL INFILE
 from sqlalchemy.dialects.mysql import MEDIUMTEXT, insert # Long text storage
 
 # Pipeline Part 1: Data ingestion (identify sources of data and create processes to collect it)
 
+# Transfer size for downloads, large blocks mean far fewer socket reads and file writes per file. The socket
+# receive buffer is left to the kernel's autotuning, which grows past what a fixed SO_RCVBUF is allowed
+ftpBlockSize = 1<<20 # 1 MB
+
 def ftp_connect(hostname, username, password):
     """
     Establishes a connection to FTP account using account information.
@@ -35,90 +50,229 @@ def download_file(ftp, remote_file_path, local_file_path):
     Returns:
         None
     """
-    with open(local_file_path, "wb") as file:
-        ftp.retrbinary("RETR " + remote_file_path, file.write)
+    with open(local_file_path, "wb", buffering=ftpBlockSize) as file:
+        ftp.retrbinary("RETR " + remote_file_path, file.write, blocksize=ftpBlockSize)
     print("File: " + local_file_path + " downloaded successfully.")
 
-def update_files(hostname, username, password, folder_path):
+def connected_download(hostname, username, password, remote_file_path, local_file_path, retries=5):
+    """
+    Opens its own connection to the FTP account and downloads a single file. FTP connections cannot be shared
+    between threads, so each concurrent download uses this. Logins refused with a temporary error (e.g. 421 too
+    many connections) are retried with a growing wait.
+    Args:
+        hostname (str): hostname of the FTP account
+        username (str): username used to login to the FTP account
+        password (str): password used to login to the FTP account
+        remote_file_path (str): File path for the ftp server.
+        local_file_path (str): File path for the local folder to write file to.
+        retries (int): number of times a refused login is retried
+    Returns:
+        None
+    """
+    for attempt in range(retries + 1):
+        try:
+            ftp = ftp_connect(hostname, username, password)
+            break
+        except error_temp:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt) # 1, 2, 4, ... seconds
+    try:
+        download_file(ftp, remote_file_path, local_file_path)
+    finally:
+        ftp.quit()
+
+def is_up_to_date(local_file_path, facts):
+    """
+    Checks if a local file matches its remote file, using the size and modification time listed by MLSD.
+    Args:
+        local_file_path (str): File path for the local copy of the file.
+        facts (dict): MLSD facts of the remote file, holding 'size' and 'modify' (YYYYMMDDhhmmss in UTC)
+    Returns:
+        bool: True if the local file has the same size and is not older than the remote file
+    """
+    if not os.path.exists(local_file_path):
+        return(False)
+    remote_time = datetime.strptime(facts["modify"][:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+    return(int(facts["size"]) == os.path.getsize(local_file_path) and remote_time <= os.path.getmtime(local_file_path))
+
+def update_files(hostname, username, password, folder_path, maxWorkers=3):
     """
     Connects to FTP account, then checks for any new files and downloads them, and checks for any updated files 
-    and downloads them.
+    and downloads them. Files are downloaded concurrently over separate connections. When the server supports
+    MLSD, files whose local copy already matches the remote size and modification time are skipped.
     Args:
         hostname (str): hostname of the FTP account
         username (str): username used to login to the FTP account
         password (str): password used to login to the FTP account
         folder_path (str): string literal defining the path of where the downloaded files should go
+        maxWorkers (int): largest number of simultaneous downloads, kept low as servers often limit logins per user
     Returns:
         None
     """
     # Establish FTP connection
     ftp = ftp_connect(hostname, username, password)
 
-    # Obtain file lists
-    fileListr = ftp.nlst() # Remote server files
+    # Obtain file lists, remote files with their size and modification time when the server supports MLSD
+    try:
+        fileListr = [(name, facts) for name, facts in ftp.mlsd(facts=["type", "size", "modify"])
+                     if facts.get("type", "file") == "file"] # Remote server files
+    except error_perm:
+        fileListr = [(name, {}) for name in ftp.nlst()] # Remote server files, names only
     fileListl = os.listdir(path=folder_path) # Local server files
     print(fileListl)
 
-    # Checks if file is already present locally, and if not then downloads (downloads new files)
-    for file in fileListr:
+    # Logs out of ftp account once the listing is done, downloads use their own connections
+    ftp.quit()
+
+    # Checks if file is already present locally, and if not then queues it for download (downloads new files)
+    downloads = []
+    for file, facts in fileListr:
         remote_file_path = file
         local_file_path = os.path.join(folder_path, file)
+        # Compares against the local copy when size and modification time are known
+        if "size" in facts and "modify" in facts:
+            if is_up_to_date(local_file_path, facts):
+                print("File: " + file + " is already up to date.")
+            else:
+                downloads.append((remote_file_path, local_file_path))
         # Downloads daily update files
-        if file.startswith("newpets") or file.startswith("updatedpets"):
-            download_file(ftp, remote_file_path, local_file_path)
+        elif file.startswith("newpets") or file.startswith("updatedpets"):
+            downloads.append((remote_file_path, local_file_path))
         # Checks for new files    
         elif file in fileListl:
             print("File: " + file + " already exists.")
         else:
-            download_file(ftp, remote_file_path, local_file_path)
+            downloads.append((remote_file_path, local_file_path))
 
-    # Logs out of ftp account when done
-    ftp.quit()
+    # Downloads the queued files concurrently, threads wait on the network rather than the GIL
+    if downloads:
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(downloads))) as executor:
+            futures = [executor.submit(connected_download, hostname, username, password, remote, local) 
+                       for remote, local in downloads]
+            for future in futures:
+                future.result() # raises any download error
 
 
 # Pipline Part 2: Convert data into usable format (zipped .json --> dataframe) and establish updating capabilities
 
-def zipReader(folder_path):
+# Read size when decompressing the zipped data
+readBufferSize = 1<<20 # 1 MB
+
+def textValue(value):
     """
-    Takes a folder_path as input, where this path leads to a zip folder. The function accesses the files inside
-    of this folder and writes it to a list and returns the list. The files are assumed to be .json.
+    Converts a parsed .json value into text, values that are not strings are kept as their .json text.
     Args:
-        folder_path (str): string literal for folder path of zip folder
+        value: value parsed from a .json entry
     Returns:
-        list: list of entries stored within the .json files in the zip folder
+        str: the value as text, None if the value is null
     """
-    
-    data = []  
+    if value is None or isinstance(value, str):
+        return(value)
+    return(orjson.dumps(value).decode('utf-8'))
+
+def rowsToTable(file):
+    """
+    Parses a .json file one entry per line into an Arrow table with every column as text. Used for files that
+    Arrow cannot read with a fixed all-string schema.
+    Args:
+        file (file): open binary file of .json entries
+    Returns:
+        Table: pyarrow table of the entries, columns in the order the fields first appear
+    """
+    rows = [orjson.loads(line) for line in file if line.strip()]
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    return(pa.table({name: pa.array([textValue(row.get(name)) for row in rows], type=pa.string()) for name in names}))
+
+def arrowReader(folder_path, blockSize=32<<20):
+    """
+    Takes a folder_path as input, where this path leads to a zip folder. The function parses the files inside
+    of this folder straight into columnar Arrow tables, yielding one table per file. The files are assumed to
+    be .json with one entry per line. Every column is read as text, like the source data, so types are left
+    for dtypeConv to decide rather than guessed per file.
+    Args:
+        folder_path (str): string literal for folder path of zip folder
+        blockSize (int): number of bytes pyarrow parses per block
+    Yields:
+        Table: pyarrow table of the entries stored within a .json file in the zip folder
+    """
+
+    readOptions = pajson.ReadOptions(block_size=blockSize)
     # Opens zip folder
     with zipfile.ZipFile(folder_path, 'r') as zip:
         # Loops for each file in the folder (only one file expected per folder for personal use case)
         for filename in zip.namelist():
-            # Opens file, expected to be .json, stores each line of file into list
+            # Takes the field names from the first entry, every field is read as a string
             with zip.open(filename) as file:
-                for line in file:
-                    row = json.loads(line.decode('utf-8'))
-                    data.append(row)
+                firstLine = file.readline()
+            fields = orjson.loads(firstLine) if firstLine.strip() else {}
+            parseOptions = pajson.ParseOptions(explicit_schema=pa.schema([(name, pa.string()) for name in fields]),
+                                               unexpected_field_behavior='error')
+            try:
+                # Opens file, expected to be .json, and parses it directly into a table, decompressing in large reads
+                with io.BufferedReader(zip.open(filename), buffer_size=readBufferSize) as file:
+                    table = pajson.read_json(file, read_options=readOptions, parse_options=parseOptions)
+            except pa.ArrowInvalid:
+                # Entries with non-string values or fields missing from the first entry are parsed row by row
+                with io.BufferedReader(zip.open(filename), buffer_size=readBufferSize) as file:
+                    table = rowsToTable(file)
             print(filename, "has been extracted.")
-    return(data)
+            yield table
 
-def initialData(folder_path):
+def tablesToDf(tables):
     """
-    Creates a df of the entire intiial data represented in the pets_1 - pets_7 files.
+    Combines a list of Arrow tables into a single dataframe, converting to pandas only once. Each column is kept
+    in its own block, since dtypeConv rebuilds the dataframe column by column, so the conversion never copies
+    every column into one consolidated block. The function takes over the tables, emptying the list, so that
+    Arrow memory is released as each column is converted.
+    Args:
+        tables (list): list of pyarrow tables, columns missing from a table are filled with nulls
+    Returns:
+        DataFrame: dataframe of every entry stored within the tables
+    """
+
+    if not tables:
+        return(pd.DataFrame())
+    table = pa.concat_tables(tables, promote_options="default")
+    tables.clear() # leaves table as the only reference to the Arrow buffers
+    return(table.to_pandas(split_blocks=True, self_destruct=True))
+
+def zipToTable(folder_path):
+    """
+    Reads every file inside of a zip folder into a single Arrow table. Kept at module level so it can be sent
+    to worker processes.
+    Args:
+        folder_path (str): string literal for folder path of zip folder
+    Returns:
+        Table: pyarrow table of the entries stored within the .json files in the zip folder
+    """
+
+    return(pa.concat_tables(list(arrowReader(folder_path)), promote_options="default"))
+
+def initialData(folder_path, maxWorkers=8):
+    """
+    Creates a df for each of the pets_1 - pets_7 files holding the intiial data. Files are parsed in parallel by
+    separate processes and handed back in order, so each chunk can be cleaned before the next one is converted,
+    instead of holding every raw entry in memory at once.
     Args: 
         folder_path (str): string literal representing the path of a folder holding all the zipped files
-    Returns:
-        DataFrame: dataframe of the entire data stored within these .json files
+        maxWorkers (int): largest number of processes used to parse the files
+    Yields:
+        DataFrame: dataframe of the data stored within a single zipped file
     """
 
     fileList = os.listdir(path=folder_path) 
-    data = []
-    # Loops over all files
-    for file in fileList:
-        # Checks if its pets_1-7
-        if file.startswith("pets_"):
-            # Appends data from file to our list
-            data.extend(zipReader(os.path.join(folder_path, file)))
-    return(pd.DataFrame(data))
+    # Checks for pets_1-7
+    paths = [os.path.join(folder_path, file) for file in fileList if file.startswith("pets_")]
+    if not paths:
+        return
+    # Parses each file in its own process, tables are cheaper to send back than dataframes
+    with ProcessPoolExecutor(max_workers=min(maxWorkers, len(paths))) as executor:
+        for table in executor.map(zipToTable, paths):
+            # Yields the tables from file as a single chunk, handing the table over so its memory can be freed
+            tables = [table]
+            del table
+            yield tablesToDf(tables)
 
 def updateData(folder_path):
     """
@@ -130,14 +284,14 @@ def updateData(folder_path):
     """
 
     fileList = os.listdir(path=folder_path) 
-    data = []
+    tables = []
     # Loops over all files
     for file in fileList:
         # Checks if its the updated data
         if file.startswith("updated") or file.startswith("new"):
-            # Appends data from file to our list
-            data.extend(zipReader(os.path.join(folder_path, file)))
-    return(pd.DataFrame(data))
+            # Appends tables from file to our list
+            tables.extend(arrowReader(os.path.join(folder_path, file)))
+    return(tablesToDf(tables))
 
 def newData(folder_path):
     """
@@ -149,17 +303,20 @@ def newData(folder_path):
     """
 
     fileList = os.listdir(path=folder_path) 
-    data = []
+    tables = []
     # Loops over all files
     for file in fileList:
         # Checks if its the new data
         if file.startswith("new"):
-            # Appends data from file to our list
-            data.extend(zipReader(os.path.join(folder_path, file)))
-    return(pd.DataFrame(data))
+            # Appends tables from file to our list
+            tables.extend(arrowReader(os.path.join(folder_path, file)))
+    return(tablesToDf(tables))
 
 # Pipeline Part 3: Prepare and clean the data
 
+# Compiled once for dtypeConv, extracts int/floats from price text
+priceRegex = re.compile(r'(\d+\.?\d*)')
+
 # Drop invalid entrees (images stored as entrees)
 def dropInvalid(df):
     '''
@@ -169,101 +326,169 @@ def dropInvalid(df):
     Returns:
         df (DataFrame): df where NaN values have been dropped
     '''
-    df.iloc[:, 1] = pd.to_numeric(df.iloc[:, 1], errors='coerce') # converts incorrect entries into NaN
-    df = df.dropna(subset=['animalID']) # drops the NaN values
+    ids = pd.to_numeric(df['animalID'], errors='coerce', dtype_backend='numpy_nullable') # incorrect entries become NA
+    valid = ids.notna().to_numpy() # boolean mask of the valid entries
+    df = df[valid].assign(animalID=ids[valid]) # drops the NA values, keeping the nullable integer ids
     print("NaN values have been successfully dropped.")
     return(df)
 
 def dtypeConv(df):
     """
     Converts the data types of inputted dataframe from object to proper fields using manually determined dtypes.
+    Each column is converted once and the typed columns are assembled into a new dataframe in a single step,
+    rather than writing every conversion back into the original dataframe.
     Args:
         df (DataFrame): dataframe whose types are being converted
     Returns:
         DataFrame: dataframe wtih correct data types
     """
-    # Mapping scheme for booleans
-    boolMap = {'Yes': True, 'No': False, '': pd.NA, None: pd.NA}
-
-    # Manual column datatype conversion
-    df[df.columns[0:2]] = df.iloc[:, 0:2].astype(int)
-    df[df.columns[2]] = df.iloc[:, 2].astype('category')
-    df[df.columns[3]] = df.iloc[:, 3].astype(int) # epoch
-    df[df.columns[4:7]] = df.iloc[:, 4:7].astype('string')
-    df[df.columns[7:12]] = df.iloc[:, 7:12].astype('category')
-    df[df.columns[12:18]] = df.iloc[:, 12:18].apply(lambda col: col.map(boolMap).astype('boolean'))
-    df[df.columns[18]] = df.iloc[:, 18].astype('category')
-    df[df.columns[19]] = pd.to_datetime(df.iloc[:, 19]).dt.normalize() # date column
-    df[df.columns[20:22]] = df.iloc[:, 20:22].apply(lambda col: col.map(boolMap).astype('boolean'))
-    df[df.columns[22]] = df.iloc[:, 22].astype('category')
-    df[df.columns[23:25]] = df.iloc[:, 23:25].replace('', np.nan).astype(float) 
-    df[df.columns[25]] = df.iloc[:, 25].astype('category')
-    df[df.columns[26]] = df.iloc[:, 26].map(boolMap).astype('boolean')
-    df[df.columns[27:30]] = df.iloc[:, 27:30].astype('category')
-    df[df.columns[30:32]] = df.iloc[:, 30:32].apply(lambda col: col.map(boolMap).astype('boolean'))
-    df[df.columns[32]] = pd.to_datetime(df.iloc[:, 32]).dt.normalize()
-    df[df.columns[33:34]] = df.iloc[:, 33:34].astype('category')
-    df[df.columns[34]] = df.iloc[:, 34].astype('string')
-    df[df.columns[35]] = pd.to_numeric(df.iloc[:, 35], errors='coerce')  # convert to float/int, then datetime
-    df[df.columns[35]] = pd.to_datetime(df.iloc[:, 35], unit='s').dt.normalize()
-    df[df.columns[36]] = df.iloc[:, 36].astype('category')
-    df[df.columns[37:40]] = df.iloc[:, 37:40].astype('string') # 37 is html code, 39 is a link
-    df[df.columns[40]] = df.iloc[:, 40].str.extract(r'(\d+\.?\d*)').astype(float) # extracts int/floats only
-    df[df.columns[41:56]] = df.iloc[:, 41:56].astype('category')
-    df[df.columns[56:94]] = df.iloc[:, 56:94].apply(lambda col: col.map(boolMap).astype('boolean'))
-    df[df.columns[94:97]] = df.iloc[:, 94:97].astype('string')
-    df[df.columns[97]] = df.iloc[:, 97].astype(int) # epoch
-    df[df.columns[98:103]] = df.iloc[:, 98:103].astype('string')
-    df[df.columns[103:105]] = df.iloc[:, 103:105].apply(lambda col: col.map(boolMap).astype('boolean'))
-    
-    df = df.replace({np.nan: None}) # turns NaNs to None
-    for col in df.select_dtypes(include=['float']).columns: # turns None in floats into 0
-        df[col] = df[col].replace(to_replace=[None, np.nan], value=0) 
+    # Conversions for each manually determined dtype
+    toInt = lambda col: col.astype(int)
+    toCategory = lambda col: col.astype('category')
+    toString = lambda col: col.astype('string')
+    toDay = lambda dates: dates.dt.tz_convert(None).dt.normalize() # UTC day without a timezone, stored as DATETIME
+    toDate = lambda col: toDay(pd.to_datetime(col, format='ISO8601', utc=True, cache=True)) # raises on non-ISO dates
+    toEpochDate = lambda col: toDay(pd.to_datetime(pd.to_numeric(col, errors='coerce'), unit='s', utc=True, cache=True))
+    toFloat = lambda col: col.replace('', np.nan).astype(float).fillna(0) # turns NaNs in floats into 0
+    toBool = lambda cols: (cols == 'Yes').astype('boolean').mask(~cols.isin(['Yes', 'No'])) # anything else is NA
+
+    # Manual column datatype conversion, (start, stop, conversion) in column order
+    schema = [
+        (0, 2, toInt),
+        (2, 3, toCategory),
+        (3, 4, toInt), # epoch
+        (4, 7, toString),
+        (7, 12, toCategory),
+        (12, 18, toBool),
+        (18, 19, toCategory),
+        (19, 20, toDate), # date column
+        (20, 22, toBool),
+        (22, 23, toCategory),
+        (23, 25, toFloat),
+        (25, 26, toCategory),
+        (26, 27, toBool),
+        (27, 30, toCategory),
+        (30, 32, toBool),
+        (32, 33, toDate),
+        (33, 34, toCategory),
+        (34, 35, toString),
+        (35, 36, toEpochDate), # epoch
+        (36, 37, toCategory),
+        (37, 40, toString), # 37 is html code, 39 is a link
+        (40, 41, lambda col: pd.to_numeric(col.str.extract(priceRegex, expand=False), errors='coerce').fillna(0.0)),
+        (41, 56, toCategory),
+        (56, 94, toBool),
+        (94, 97, toString),
+        (97, 98, toInt), # epoch
+        (98, 103, toString),
+        (103, 105, toBool),
+    ]
+    conversions = {}
+    for start, stop, conversion in schema:
+        for col in df.columns[start:stop]:
+            conversions[col] = conversion
+
+    # Boolean columns are converted together in one pass
+    bools = toBool(df[[col for col, conversion in conversions.items() if conversion is toBool]])
+
+    # Converts every column once, then builds the dataframe in one go
+    typed = {}
+    for col in df.columns:
+        if col in bools:
+            typed[col] = bools[col]
+        elif col in conversions:
+            typed[col] = conversions[col](df[col])
+        else:
+            typed[col] = df[col]
+    df = pd.DataFrame(typed, index=df.index, copy=False) # missing values stay as NA / NaT until upload
 
     print("Data types have successfully been converted.")
     return df
 
-def schemaConv(df):
+def writeParquet(df, path):
+    """
+    Saves the cleaned initial data as a .parquet file, so a repeated initial load can skip parsing and converting
+    the pets_1 - pets_7 files.
+    Args:
+        df (DataFrame): dataframe with converted data types
+        path (str): path of the .parquet file
+    Returns:
+        None
+    """
+    df.to_parquet(path, engine='pyarrow', compression='zstd', row_group_size=100_000, index=False)
+    print(path, "has been saved.")
+
+def readParquet(path):
+    """
+    Loads a cleaned dataframe saved by writeParquet, data types (including categories) are restored.
+    Args:
+        path (str): path of the .parquet file
+    Returns:
+        DataFrame: dataframe with converted data types
+    """
+    return(pq.read_table(path).to_pandas())
+
+def parquetIsCurrent(path, folder_path, prefix):
+    """
+    Checks if a .parquet file exists and was saved after every zipped file it was built from.
+    Args:
+        path (str): path of the .parquet file
+        folder_path (str): string literal representing the path of a folder holding the zipped files
+        prefix (str): start of the names of the zipped files the .parquet file was built from
+    Returns:
+        bool: True if the .parquet file can be used instead of the zipped files
+    """
+    if not os.path.exists(path):
+        return(False)
+    sources = [os.path.join(folder_path, file) for file in os.listdir(path=folder_path) if file.startswith(prefix)]
+    return(all(os.path.getmtime(source) <= os.path.getmtime(path) for source in sources))
+
+def replaceColumns(df, newCols):
     '''
-    Converts the schema of category columns into foreign keys.
+    Swaps columns of a dataframe for new ones, building the result in a single step instead of assigning each
+    column into the existing dataframe.
     Args:
-        df (DataFrame): df with columns to be converted
+        df (DataFrame): dataframe whose columns are replaced
+        newCols (dictionary): new columns keyed by the name of the column they replace
     Returns:
-        df (DataFrame): a dataframe with the converted columns
-        LookupTables (dictionary): a dictionary of lookup tables for each column
+        DataFrame: dataframe with the replaced columns, in the original column order
     '''
+    return(pd.DataFrame({col: newCols.get(col, df[col]) for col in df.columns}, index=df.index, copy=False))
 
-    # Stores category columns
-    catList = [col for col in df.select_dtypes(include='category')]
-    
-    # Create lookup table
-    lookupTables = {}
-    for col in catList:
-        uniqueVals = sorted(df[col].cat.categories)
-        # Filters for >5 values
-        if (len(uniqueVals)>5):
-            lookup_df = pd.DataFrame({
-                'id': range(1, len(uniqueVals)+1),
-                'value': uniqueVals
-            })
-            lookupTables[col] = lookup_df
-
-    # Convert df columns into foreign key 
-    for col, lookup_df in lookupTables.items():
-        # Create mapping and replace
-        mapping = dict(zip(lookup_df['value'], lookup_df['id']))
-        df[col] = df[col].map(mapping)
-        df[col] = df[col].astype("Int32")
-    
-    
-    print("Dataframe Schema successfully converted.")
-    # Save as .json
-    serializable_lookup = {col: lookupTables[col].to_dict(orient='records') for col in lookupTables}
-    with open("lookupTables.json", "w") as f:
-        json.dump(serializable_lookup, f)
+def categoryIds(col, values):
+    '''
+    Converts a category column into the ids of a lookup table, reusing the integer codes the column already
+    carries instead of looking up every row.
+    Args:
+        col (Series): category column to be converted
+        values (list): lookup table values, where the value at position i has id i+1
+    Returns:
+        Series: column of lookup ids, NA where the value is missing from the lookup table
+    '''
+    codes = col.cat.set_categories(values).cat.codes.to_numpy() # -1 for values not in the lookup table
+    return(pd.Series(codes + 1, index=col.index, dtype="Int32").mask(codes == -1))
 
-    # Return df and lookuptable
-    return(df, lookupTables)
+def lookupColumns(df):
+    '''
+    Finds the category columns that get converted into foreign keys, those with more than 5 values.
+    Args:
+        df (DataFrame): df with category columns
+    Returns:
+        list: names of the columns that need lookup tables
+    '''
+    return([col for col in df.select_dtypes(include='category') if len(df[col].cat.categories) > 5])
+
+def saveLookupTables(lookupTables):
+    '''
+    Saves the lookup tables as .json so later runs can convert their schema with schemaConv2.
+    Args:
+        lookupTables (dictionary): a dictionary of lookup tables for each column
+    Returns:
+        None
+    '''
+    serializable_lookup = {col: lookupTables[col].to_dict(orient='records') for col in lookupTables}
+    with open("lookupTables.json", "wb") as f:
+        f.write(orjson.dumps(serializable_lookup, option=orjson.OPT_SERIALIZE_NUMPY))
 
 def schemaConv2(df):
     '''
@@ -275,19 +500,15 @@ def schemaConv2(df):
     '''
 
     # Opens .json with lookuptables
-    with open("lookupTables.json", "r") as f:
-        loaded = json.load(f)
+    with open("lookupTables.json", "rb") as f:
+        loaded = orjson.loads(f.read())
 
         # Convert back to DataFrame
         lookupTables = {col: pd.DataFrame(loaded[col]) for col in loaded}
     
-    # Convert schema
-    catList = [col for col in df.select_dtypes(include='category')]
-    for col in catList:
-        if col in lookupTables:
-            mapping = dict(zip(lookupTables[col]['value'], lookupTables[col]['id']))
-            df[col] = df[col].map(mapping)
-    df = df.replace({np.nan: None})
+    # Convert schema, lookup tables are stored in id order so position i holds id i+1
+    catList = [col for col in df.select_dtypes(include='category') if col in lookupTables]
+    df = replaceColumns(df, {col: categoryIds(df[col], lookupTables[col].sort_values('id')['value']) for col in catList})
     print("Schema successfully converted.")
 
     # Return df
@@ -297,10 +518,76 @@ def schemaConv2(df):
 
 # Pipeline Part 4: Store the processed data into SQL database
 
+@functools.lru_cache(maxsize=1)
+def get_engine(host, username, password, database):
+    '''
+    Creates the SQL engine once and hands back the same engine on every later call, so its connection pool
+    is reused instead of reconnecting for every upload.
+    Args:
+        host (str): host key for connection
+        username (str): username to sign in for connection
+        password (str): password to sign in for connection
+        database (str): the database to connect to
+    Returns:
+        engine (Engine): SQLAlchemy engine for the database
+    '''
+    return(create_engine(f"mysql+pymysql://{username}:{password}@{host}/{database}", pool_size=8, pool_pre_ping=True,
+                         connect_args={"local_infile": True})) # allows LOAD DATA LOCAL INFILE
+
+def csvConv(df):
+    '''
+    Converts the columns of a dataframe into the plain values MySQL expects when loading a .csv file, booleans
+    as 1 / 0 and dates as 'YYYY-MM-DD hh:mm:ss' in UTC.
+    Args:
+        df (DataFrame): dataframe to be written as .csv
+    Returns:
+        DataFrame: dataframe with the converted columns
+    '''
+    csvCols = {}
+    for col in df.columns:
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind == 'boolean':
+            csvCols[col] = df[col].astype('boolean').astype('Int8')
+        elif kind in ('datetime', 'datetime64'):
+            csvCols[col] = pd.to_datetime(df[col], utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            csvCols[col] = df[col]
+    return(pd.DataFrame(csvCols, index=df.index, copy=False))
+
+def csvField(col):
+    '''
+    Converts a column into the text of a LOAD DATA field, using MySQL's default escaping. Missing values become
+    \\N, and backslashes, commas, quotes and line breaks in the data are escaped with a backslash, so text such as
+    'NULL' is always loaded as text.
+    Args:
+        col (Series): column converted by csvConv
+    Returns:
+        Series: column of field text
+    '''
+    fieldText = col.astype('string').str.replace(r'([\\,"])', r'\\\1', regex=True)
+    fieldText = fieldText.str.replace('\n', '\\n', regex=False).str.replace('\r', '\\r', regex=False)
+    return(fieldText.fillna('\\N'))
+
+def writeLoadFile(df, path, chunkSize=100_000):
+    '''
+    Writes a dataframe into a file for LOAD DATA LOCAL INFILE, comma separated with one row per line.
+    Args:
+        df (DataFrame): dataframe to be written
+        path (str): path of the file
+        chunkSize (int): number of rows converted to text at a time
+    Returns:
+        None
+    '''
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        for start in range(0, len(df), chunkSize):
+            fields = [csvField(col) for _, col in csvConv(df.iloc[start:start + chunkSize]).items()]
+            file.write(fields[0].str.cat(fields[1:], sep=',').str.cat(sep='\n') + '\n')
+
 def inConnection(host, username, password, database, df, table):
     '''
     Establishes a connection to SQL DB using credentials and turns df into sql table. Replaces original
-    table. Only use if implementing table from scratch.
+    table. Only use if implementing table from scratch. The data is bulk loaded with LOAD DATA LOCAL INFILE,
+    falling back to multi-row inserts when local_infile is disabled on the server.
     Args:
         host (str): host key for connection
         username (str): username to sign in for connection
@@ -312,8 +599,8 @@ def inConnection(host, username, password, database, df, table):
         None 
     '''
 
-    # Creates engine
-    engine = create_engine(f"mysql+pymysql://{username}:{password}@{host}/{database}")
+    # Gets engine
+    engine = get_engine(host, username, password, database)
 
     # Detects and converts long text column dtype
     dtype_map = {}
@@ -322,13 +609,33 @@ def inConnection(host, username, password, database, df, table):
     if "pictures" in df.columns:
         dtype_map["pictures"] = MEDIUMTEXT()
 
-    df.to_sql(
-        name=table.lower(),
-        con=engine,
-        if_exists='replace',
-        index=False,
-        dtype=dtype_map
-    )
+    # Creates the table from the df's column types
+    name = table.lower()
+    schema = pd.io.sql.get_schema(df, name, con=engine, dtype=dtype_map)
+    columns = ", ".join(f"`{col}`" for col in df.columns)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS `{name}`"))
+        conn.execute(text(schema))
+
+    # Bulk loads the df through a file rather than row by row inserts
+    with tempfile.TemporaryDirectory() as folder:
+        loadPath = os.path.join(folder, f"{name}.txt")
+        writeLoadFile(df, loadPath)
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"""
+                                  LOAD DATA LOCAL INFILE :path INTO TABLE `{name}`
+                                  CHARACTER SET utf8mb4
+                                  FIELDS TERMINATED BY ',' ESCAPED BY '\\\\'
+                                  LINES TERMINATED BY '\\n'
+                                  ({columns});
+                                  """), {"path": loadPath})
+        except DBAPIError as error:
+            # 3948 / 1148: loading local data is disabled on the server
+            if error.orig.args[0] not in (3948, 1148):
+                raise
+            print("LOAD DATA LOCAL INFILE is disabled, loading with multi-row inserts instead.")
+            df.to_sql(name=name, con=engine, if_exists='append', index=False, method='multi', chunksize=1000)
 
     # Adds primary key to pets table
     if table == ('pets'):
@@ -343,29 +650,84 @@ def inConnection(host, username, password, database, df, table):
                               ALTER TABLE new_pets
                               ADD PRIMARY KEY (animalID);
                               """))
-    
 
     print(f"{table} has been successfully loaded into SQL DB.")
 
 
-def uploadLookupTables(host, username, password, database, lookupDict):
+def dbSchemaConv(host, username, password, database, tableName, columns):
     '''
-    Uploads every key value pair (name : df) inside of a dictionary
+    Converts the schema of category columns of a table already in the SQL DB into foreign keys, doing the work
+    inside the database. Each lookup table is filled from the distinct values of its column and the column is
+    replaced by the matching ids through a join, so the data is not mapped in Python or uploaded twice.
+    MySQL commits each DDL step as it runs, so a conversion cannot be rolled back. Instead every column is
+    converted in steps that are safe to repeat: columns that are already ids are skipped and leftovers from an
+    interrupted run are cleared. If a run fails partway, re-run this function to finish the conversion and
+    write lookupTables.json.
     Args:
         host (str): host key for connection
         username (str): username to sign in for connection
         password (str): password to sign in for connection
-        database (str): the database to create the table in
-        lookupDict (dictionary): dictionary holding all the tables to be uploaded
+        database (str): the database holding the table
+        tableName (str): name of the table whose columns are converted
+        columns (list): names of the category columns to be converted
     Returns:
-        None 
+        LookupTables (dictionary): a dictionary of lookup tables for each column
     '''
-    for col, lookup_df in lookupDict.items():
-        inConnection(host, username, password, database, lookup_df, col)
 
-def upConnection(host, username, password, database, df, tableName):
+    # Gets engine
+    engine = get_engine(host, username, password, database)
+
+    lookupTables = {}
+    with engine.begin() as conn:
+        # Current column types, to tell converted columns apart from ones still holding values
+        dataTypes = dict(conn.execute(text("""
+                                           SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS
+                                           WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :tableName
+                                           """), {"tableName": tableName}).all())
+        for col in columns:
+            lookup = col.lower()
+            # Skips columns already converted by an earlier run, their lookup table is complete
+            if dataTypes.get(col) != 'int':
+                # Clears the id column left behind by an interrupted run
+                if f"{col}_id" in dataTypes:
+                    conn.execute(text(f"ALTER TABLE `{tableName}` DROP COLUMN `{col}_id`"))
+                # Lookup table, ids follow the sorted order of the values. The NO PAD binary collation keeps 'Lab' and
+                # 'Lab ' apart as Python does, and the prefix index on value serves the join below
+                conn.execute(text(f"DROP TABLE IF EXISTS `{lookup}`"))
+                conn.execute(text(f"""
+                                  CREATE TABLE `{lookup}` (
+                                      id INT AUTO_INCREMENT PRIMARY KEY,
+                                      value TEXT COLLATE utf8mb4_0900_bin,
+                                      INDEX (value(255))
+                                  );
+                                  """))
+                conn.execute(text(f"""
+                                  INSERT INTO `{lookup}` (value)
+                                  SELECT DISTINCT `{col}` COLLATE utf8mb4_0900_bin AS value FROM `{tableName}`
+                                  WHERE `{col}` IS NOT NULL
+                                  ORDER BY value;
+                                  """))
+                # Replaces the column with its foreign key, keeping the column position, the final swap is a
+                # single statement so the column is never missing
+                conn.execute(text(f"ALTER TABLE `{tableName}` ADD COLUMN `{col}_id` INT AFTER `{col}`"))
+                conn.execute(text(f"""
+                                  UPDATE `{tableName}` t JOIN `{lookup}` l ON t.`{col}` COLLATE utf8mb4_0900_bin = l.value
+                                  SET t.`{col}_id` = l.id;
+                                  """))
+                conn.execute(text(f"ALTER TABLE `{tableName}` DROP COLUMN `{col}`, CHANGE `{col}_id` `{col}` INT"))
+            # Only the small lookup table comes back, for schemaConv2 to use on later runs
+            lookupTables[col] = pd.read_sql(text(f"SELECT id, value FROM `{lookup}` ORDER BY id"), conn)
+
+    print(f"{tableName} schema successfully converted in SQL DB.")
+    # Save as .json
+    saveLookupTables(lookupTables)
+
+    return(lookupTables)
+
+def upConnection(host, username, password, database, df, tableName, batchSize=1000):
     '''
-    Establishes a connection to SQL DB and then upserts data into the specified table.
+    Establishes a connection to SQL DB and then upserts data into the specified table. Rows are sent in
+    batches, each batch as a single multi-row upsert statement.
     Args:
         host (str): host key for connection
         username (str): username to sign in for connection
@@ -373,45 +735,33 @@ def upConnection(host, username, password, database, df, tableName):
         database (str): the database to create the table in
         df (DataFrame): dataframe that gets exported into sql table
         table (str): name of the table
+        batchSize (int): number of rows sent per upsert statement
     Returns:
         None 
     '''
 
-    # Creates engine
-    engine = create_engine(f"mysql+pymysql://{username}:{password}@{host}/{database}")
+    # Gets engine
+    engine = get_engine(host, username, password, database)
     metadata = MetaData()
     
     # Reflect table
     table = Table(tableName, metadata, autoload_with=engine)
 
     # Upsert statements 
-    records = df.to_dict("records")
-    '''stmt = insert(table).values(records)
-    update_dict = {
-        col.name: stmt.inserted[col.name]
-        for col in table.columns
-        if col.name not in [pk.name for pk in table.primary_key.columns]
-    }
-    upsert_stmt = stmt.on_duplicate_key_update(**update_dict)
-
-    # Execute
-    with engine.begin() as conn:
-        conn.execute(upsert_stmt)'''
-    
-    from sqlalchemy.dialects.mysql import insert
-
     pk_cols = [pk.name for pk in table.primary_key.columns]
 
+    # Execute, every batch shares one transaction
     with engine.begin() as conn:
-        for record in records:  # single-row insert
-            stmt = insert(table).values(record)
+        for i in range(0, len(df), batchSize):
+            batch = df.iloc[i:i + batchSize]
+            records = batch.astype(object).where(batch.notna(), None).to_dict("records") # NA / NaN / NaT to NULL
+            stmt = insert(table).values(records) # multi-row insert
             update_dict = {
                 col.name: stmt.inserted[col.name] 
                 for col in table.columns if col.name not in pk_cols
             }
             conn.execute(stmt.on_duplicate_key_update(**update_dict))
 
-    
     print(f"{tableName} has been successfully updated.")
 
 
@@ -441,12 +791,17 @@ def singleUseProcesses():
 
     # Single-time processes
     update_files(ftpHostname, ftpUsername, ftpPassword, ftpFolder_path) # downloads files
-    inData = initialData(ftpFolder_path) # processes initial files into a single dataframe
-    inData = dropInvalid(inData) # drops invalid entries
-    inData = dtypeConv(inData) # converts dtypes
-    inData, lookupTables = schemaConv(inData) # converts schema
+    inPath = os.path.join(ftpFolder_path, "pets.parquet") # cleaned initial data from an earlier run
+    if parquetIsCurrent(inPath, ftpFolder_path, "pets_"):
+        inData = readParquet(inPath) # skips processing when the pets files have not changed
+    else:
+        inData = [dropInvalid(chunk) for chunk in initialData(ftpFolder_path)] # processes and drops invalid entries file by file
+        inData = pd.concat(inData, ignore_index=True) # combines the cleaned chunks into a single dataframe
+        inData = dtypeConv(inData) # converts dtypes
+        writeParquet(inData, inPath) # saves the cleaned data
+    lookupCols = lookupColumns(inData) # finds columns needing lookup tables
     inConnection(dbHost, dbUsername, dbPassword, database, inData, 'pets') # uploads initial pet df
-    uploadLookupTables(dbHost, dbUsername, dbPassword, database, lookupTables) # uploads lookup tables
+    dbSchemaConv(dbHost, dbUsername, dbPassword, database, 'pets', lookupCols) # converts schema and creates lookup tables in DB
 
     nData = newData(ftpFolder_path) # processes the new files into a single dataframe
     nData = dropInvalid(nData) # drops invalid entries
@@ -477,8 +832,10 @@ def automaticProcesses():
     nData = schemaConv2(nData) # converts schema
     upConnection(dbHost, dbUsername, dbPassword, database, nData, 'new_pets') # uploads new pet df
 
-# Runs the single time processes
-# singleUseProcesses()
+# Guarded so worker processes importing this module do not rerun the pipeline
+if __name__ == "__main__":
+    # Runs the single time processes
+    # singleUseProcesses()
 
-# Runs the update processes
-automaticProcesses()
+    # Runs the update processes
+    automaticProcesses()